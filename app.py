@@ -1,6 +1,14 @@
+# Patch stdlib sockets before anything imports them so blocking I/O yields to other requests
+from gevent import monkey
+monkey.patch_all()
+
+import hmac
 import logging
+import os
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from datetime import datetime
@@ -8,13 +16,19 @@ from enum import Enum
 from sqlalchemy.sql.expression import func
 from openai import OpenAI
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from cachetools import TTLCache
 from secrets_manager import get_service_secrets
+from llm_cache import SemanticCache
 # Configure logging
 logging.basicConfig(
     level=logging.INFO, 
     format='%(asctime)s - %(levelname)s - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
@@ -24,12 +38,23 @@ secrets = get_service_secrets('gnosis-influencer')
 API_KEY = secrets.get('API_KEY')
 
 C_PORT = int(secrets.get('PORT', 5000))
+# Concurrent requests per gunicorn worker, from the same environment variable
+# gunicorn.conf.py reads; the downstream HTTP pools below are sized from it
+WORKER_CONNECTIONS = int(os.environ.get('WORKER_CONNECTIONS', 100))
 SQLALCHEMY_DATABASE_URI = (
     f"mysql+pymysql://{secrets['MYSQL_USER']}:{secrets['MYSQL_PASSWORD_CONVOS']}"
-    f"@{secrets['MYSQL_HOST']}:{secrets['MYSQL_PORT']}/{secrets['MYSQL_DATABASE']}"
+    f"@{secrets['MYSQL_HOST']}:{secrets['MYSQL_PORT']}/{secrets['MYSQL_DATABASE']}?charset=utf8mb4"
 )
 app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Keep a warm pool of connections to RDS instead of reconnecting per request
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': 10,
+    'max_overflow': 20,
+    'pool_timeout': 30,
+    'pool_recycle': 1800,  # recycle before RDS closes idle connections
+    'pool_pre_ping': True
+}
 
 db = SQLAlchemy(app)
 
@@ -40,9 +65,51 @@ PROFILES_API_URL = secrets.get('PROFILES_API_URL')
 QUERIES_API_URL = secrets.get('QUERY_API_URL')
 GRAPHQL_API_URL = secrets.get('GRAPHQL_API_URL') # http://54.159.168.135:5000/graphql 
 
+# Shared keep-alive session for downstream service calls
+HTTP = requests.Session()
+HTTP.headers['X-API-KEY'] = API_KEY
+_adapter = HTTPAdapter(
+    pool_connections=20,
+    # Each in-flight request can have two downstream calls open at once
+    pool_maxsize=2 * WORKER_CONNECTIONS,
+    # Hand back the last response once retries run out so callers' status checks still apply
+    max_retries=Retry(total=2, backoff_factor=0.1, status_forcelist=[502, 503, 504], raise_on_status=False)
+)
+HTTP.mount('http://', _adapter)
+HTTP.mount('https://', _adapter)
+
+# In-process cache of AI profiles by content_id
+_profile_cache = TTLCache(maxsize=1024, ttl=int(secrets.get('PROFILE_CACHE_TTL', 300)))
+_profile_lock = Lock()
+
+# Shared pool for issuing independent downstream HTTP calls in parallel
+http_executor = ThreadPoolExecutor(max_workers=int(secrets.get('HTTP_WORKERS', 2 * WORKER_CONNECTIONS)))
+
+# Only the most recent messages are sent to GPT-4o as conversation context
+MAX_CONTEXT_MESSAGES = int(secrets.get('MAX_CONTEXT_MESSAGES', 20))
+
+# Prompt templates for the final user turn sent to GPT-4o
+_JSON_REPLY_INSTRUCTIONS = (
+    '\nReply in json format as an object with a list of tweets, in the form '
+    '{{"tweets": [{{"tweet": "tweet text"}}, {{"tweet": "tweet text"}}, ...]}}'
+    '\n\nContent: {chunk_text}'
+)
+FIRST_MESSAGE_PROMPT = (
+    "Write an informative twitter thread that explains the point you're making below."
+    + _JSON_REPLY_INSTRUCTIONS
+)
+REPLY_PROMPT = (
+    "Reply to the user's query based on the following content. \nUser query: {user_query}"
+    + _JSON_REPLY_INSTRUCTIONS
+)
+
 # Initialize OpenAI client
 client = OpenAI(api_key=OPENAI_API_KEY)
 
+# Semantic response cache, shared across instances via Redis
+LLM_CACHE_ENABLED = str(secrets.get('LLM_CACHE_ENABLED', 'false')).lower() in ('1', 'true', 'yes')
+llm_cache = SemanticCache(secrets['REDIS_URL']) if LLM_CACHE_ENABLED else None
+
 # Models (Copied from gnosis-convos)
 class SenderType(Enum):
     user = 'user'
@@ -66,69 +133,133 @@ class Message(db.Model):
     message_text = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime(timezone=True), default=func.now(), nullable=False)
 
+def iter_json_objects(fragments):
+    """
+    Incrementally parse streamed JSON text, yielding each innermost object
+    (e.g. {"tweet": "..."}) as soon as its closing brace arrives.
+
+    Raises ValueError once the text runs out if the document was never
+    closed, so a truncated reply is not mistaken for a complete one.
+    """
+    buffer = ''
+    pos = 0
+    open_objects = []  # [start index, contains a nested object]
+    open_arrays = 0
+    in_string = escaped = False
+    for fragment in fragments:
+        buffer += fragment
+        while pos < len(buffer):
+            char = buffer[pos]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == '{':
+                if open_objects:
+                    open_objects[-1][1] = True
+                open_objects.append([pos, False])
+            elif char == '}' and open_objects:
+                start, has_nested = open_objects.pop()
+                if not has_nested:
+                    yield json.loads(buffer[start:pos + 1])
+            elif char == '[':
+                open_arrays += 1
+            elif char == ']' and open_arrays:
+                open_arrays -= 1
+            pos += 1
+    if in_string or open_objects or open_arrays:
+        raise ValueError("Incomplete JSON document in response")
+
+def iter_completion_text(stream):
+    """
+    Yield the text of a streamed chat completion, raising ValueError at the
+    end unless the model finished normally (e.g. not cut off by max tokens).
+    """
+    finish_reason = None
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if choice.delta.content:
+            yield choice.delta.content
+        if choice.finish_reason:
+            finish_reason = choice.finish_reason
+    if finish_reason != 'stop':
+        raise ValueError(f"GPT-4o reply did not complete (finish_reason: {finish_reason})")
+
 @app.route('/api/message/ai', methods=['POST'])
 def post_message_ai():
     """
     Update a conversation with an AI response.
 
+    Streams the generated tweets back as newline-delimited JSON, one
+    {"tweet": ...} object per line, followed by a final acknowledgment
+    line. The tweets are saved only once the whole reply has been
+    generated, even if the client disconnects mid-stream.
+
+    Failures after streaming has started (invalid or truncated GPT-4o
+    output, database errors) cannot change the status code: the response
+    is still HTTP 200 and ends with an {"error": ...} line instead of the
+    acknowledgment, and nothing is saved. Callers must check the last line.
+
     Expected JSON payload:
     {
         "conversation_id": <int>,
         "content_chunk_id": <int, optional>
     }
     """
+    started = time.monotonic()
     data = request.get_json()
-    logging.info(f"Received request data: {data}")
+    log.debug("Received request data: %s", data)
     
     if not data or 'conversation_id' not in data:
-        logging.warning("Missing conversation_id in request data.")
+        log.warning("Missing conversation_id in request data.")
         return jsonify({'error': 'conversation_id is required'}), 400
 
     conversation_id = data['conversation_id']
     content_chunk_id = data.get('content_chunk_id')
     correlation_id = request.headers.get('X-Correlation-ID')  # Get correlation ID from headers
-    logging.info(f"Processing conversation_id: {conversation_id}, content_chunk_id: {content_chunk_id}")
+    log.debug("Processing conversation_id: %s, content_chunk_id: %s", conversation_id, content_chunk_id)
 
     try:
-        # Step 1: Fetch the conversation and messages
-        conversation = Conversation.query.get(conversation_id)
-        if not conversation:
-            logging.warning(f"Conversation not found for id: {conversation_id}")
+        # Step 1: Fetch the conversation and its most recent messages in one round-trip
+        rows = db.session.execute(
+            db.select(Conversation.user_id, Conversation.content_id, Message.sender, Message.message_text)
+            .outerjoin(Message, Message.conversation_id == Conversation.id)
+            .where(Conversation.id == conversation_id)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(MAX_CONTEXT_MESSAGES)
+        ).all()
+        if not rows:
+            log.warning("Conversation not found for id: %s", conversation_id)
             return jsonify({'error': 'Conversation not found'}), 404
 
-        # Get all messages in the conversation
-        messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.timestamp).all()
-        logging.info(f"Retrieved {len(messages)} messages for conversation_id: {conversation_id}")
-
-        # Step 2: Get AI persona via profiles API
-        headers = {'X-API-KEY': API_KEY}
-        if correlation_id:
-            headers['X-Correlation-ID'] = correlation_id
-        ai_profile_resp = requests.get(f"{PROFILES_API_URL}/api/ais/content/{conversation.content_id}", headers=headers)
-        if ai_profile_resp.status_code != 200:
-            logging.error("Failed to retrieve AI profile")
-            logging.error(f"Response: {ai_profile_resp.text}")
-            return jsonify({'error': 'Failed to retrieve AI profile'}), 500
-
-        ai_profile = ai_profile_resp.json()
-        systems_instructions = ai_profile.get('systems_instructions', '')
-        logging.info("Successfully retrieved AI profile and systems instructions.")
-
-        # Step 3: Get the chunk text
+        user_id, content_id = rows[0].user_id, rows[0].content_id
+        # (sender, message_text) pairs, oldest first; a conversation without
+        # messages yields a single row with no sender
+        messages = [(sender, text) for _, _, sender, text in reversed(rows) if sender is not None]
+        # Return the connection to the pool now rather than holding it through the
+        # downstream calls and the GPT-4o stream; only the final insert needs one again
+        db.session.close()
+        log.debug("Retrieved %d messages for conversation_id: %s", len(messages), conversation_id)
+
+        # Step 2: Fire the AI persona and chunk lookups concurrently; they are independent
+        headers = {'X-Correlation-ID': correlation_id} if correlation_id else {}
         if content_chunk_id:
             # Get chunk text via gnosis-query
-            chunk_resp = requests.get(f"{QUERIES_API_URL}/api/chunk/{content_chunk_id}", headers=headers)
-            if chunk_resp.status_code != 200:
-                logging.error("Failed to retrieve chunk text")
-                return jsonify({'error': 'Failed to retrieve chunk text'}), 500
-            chunk_data = chunk_resp.json()
-            chunk_text = chunk_data['text']
-            logging.info(f"Retrieved chunk text for content_chunk_id: {content_chunk_id}")
+            chunk_future = http_executor.submit(
+                HTTP.get, f"{QUERIES_API_URL}/api/chunk/{content_chunk_id}", headers=headers
+            )
         else:
             # Use most recent two messages to find similar chunk (concatenate them)
-            last_messages = [msg for msg in reversed(messages)][:2]
+            last_messages = messages[-2:][::-1]
             if len(last_messages) == 0:
-                logging.warning("No user messages found to base AI response on.")
+                log.warning("No user messages found to base AI response on.")
                 return jsonify({'error': 'No user message found to base AI response on'}), 400
 
             # Search for similar chunks using GraphQL
@@ -145,12 +276,13 @@ def post_message_ai():
             """
             
             variables = {
-                "userId": str(conversation.user_id),  # GraphQL expects string
-                "queryText": ' '.join([msg.message_text for msg in last_messages]),
+                "userId": str(user_id),  # GraphQL expects string
+                "queryText": ' '.join(text for _, text in last_messages),
                 "limit": 1
             }
             
-            search_resp = requests.post(
+            search_future = http_executor.submit(
+                HTTP.post,
                 GRAPHQL_API_URL,
                 headers=headers,
                 json={
@@ -158,103 +290,194 @@ def post_message_ai():
                     "variables": variables
                 }
             )
-            # logging.info(f"GraphQL search response: {search_resp.json()}")
+
+        # AI personas rarely change, so only hit the profiles API on a cache miss
+        with _profile_lock:
+            ai_profile = _profile_cache.get(content_id)
+        if ai_profile is None:
+            ai_profile_future = http_executor.submit(
+                HTTP.get, f"{PROFILES_API_URL}/api/ais/content/{content_id}", headers=headers
+            )
+
+            ai_profile_resp = ai_profile_future.result()
+            if ai_profile_resp.status_code != 200:
+                log.error("Failed to retrieve AI profile. Response: %s", ai_profile_resp.text)
+                return jsonify({'error': 'Failed to retrieve AI profile'}), 500
+
+            ai_profile = ai_profile_resp.json()
+            with _profile_lock:
+                _profile_cache[content_id] = ai_profile
+
+        # Normalized so the system prompt is byte-identical across turns and hits OpenAI's prompt cache
+        systems_instructions = (ai_profile.get('systems_instructions') or '').replace('\r\n', '\n').strip()
+        log.debug("Successfully retrieved AI profile and systems instructions.")
+
+        # Step 3: Get the chunk text
+        if content_chunk_id:
+            chunk_resp = chunk_future.result()
+            if chunk_resp.status_code != 200:
+                log.error("Failed to retrieve chunk text")
+                return jsonify({'error': 'Failed to retrieve chunk text'}), 500
+            chunk_data = chunk_resp.json()
+            chunk_text = chunk_data['text']
+            log.debug("Retrieved chunk text for content_chunk_id: %s", content_chunk_id)
+        else:
+            search_resp = search_future.result()
+            # log.debug("GraphQL search response: %s", search_resp.json())
             if search_resp.status_code != 200:
-                logging.error("Failed to perform GraphQL search")
+                log.error("Failed to perform GraphQL search")
                 return jsonify({'error': 'Failed to perform search'}), 500
 
             search_result = search_resp.json()
             if 'errors' in search_result:
-                logging.error(f"GraphQL errors: {search_result['errors']}")
+                log.error("GraphQL errors: %s", search_result['errors'])
                 return jsonify({'error': 'Failed to perform search'}), 500
 
             if not search_result.get('data', {}).get('searchSimilarChunks'):
-                logging.warning("No similar content found for AI to respond with.")
+                log.warning("No similar content found for AI to respond with.")
                 return jsonify({'error': 'No similar content found for AI to respond with'}), 400
 
             top_result = search_result['data']['searchSimilarChunks'][0]
             content_chunk_id = top_result['chunkId']
             chunk_text = top_result['text']
-            logging.info(f"Found similar chunk with id: {content_chunk_id}")
+            log.debug("Found similar chunk with id: %s", content_chunk_id)
 
         # Step 4: Prepare conversation context
-        conversation_context = []
-        user_query = ''
-        for msg in messages:
-            role = 'user' if msg.sender == SenderType.user else 'assistant'
-            conversation_context.append({'role': role, 'content': msg.message_text})
-            if msg.sender == SenderType.user:
-                user_query = msg.message_text
-                logging.info(f"Last user message: {user_query}")
-
-        # Step 5: Generate AI response
+        conversation_context = [
+            {'role': 'user' if sender == SenderType.user else 'assistant', 'content': text}
+            for sender, text in messages
+        ]
+        user_query = next((text for sender, text in reversed(messages) if sender == SenderType.user), '')
+        log.debug("Last user message: %s", user_query)
+
+        # Step 5: Generate AI response. The system prompt and history form a stable
+        # prefix; only the final user turn (query + chunk text) varies per request.
         prompt_messages = [
             {'role': 'system', 'content': systems_instructions},
             *conversation_context
         ]
-        # Determine if it's the first message or a reply
-        if len(messages) == 0:
-            # First message: create social media post
-            prompt = f"Write an informative twitter thread that explains the point you're making below."
-        else:
-            # Subsequent messages: reply to conversation
-            prompt = f"Reply to the user's query based on the following content. \nUser query: {user_query}"
-        
-        prompt += "\nReply in json format as a list of tweets, in the form [{'tweet': 'tweet text'}, {'tweet': 'tweet text'}, ...]"
-        prompt += f"\n\nContent: {chunk_text}"
+        # Determine if it's the first message (create social media post) or a reply
+        prompt = (FIRST_MESSAGE_PROMPT if len(messages) == 0 else REPLY_PROMPT).format(
+            user_query=user_query, chunk_text=chunk_text
+        )
 
         prompt_messages.append({'role': 'user', 'content': prompt})
 
-        # Make API call to GPT-4o
-        logging.info("Making API call to GPT-4o for response generation.")
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=prompt_messages
-        )
-
-        response_json = json.loads(response.choices[0].message.content.strip().replace("```json", "").replace("```", ""))
-        logging.info("Received response from GPT-4o.")
-
-        try:
-            for tweet in response_json:                
-                # Step 6: Add AI message to the conversation
-                ai_message = Message(
-                    conversation_id=conversation_id,
-                    sender=SenderType.ai,
-                    message_text=tweet['tweet'],
-                    content_chunk_id=content_chunk_id
-                )
-                db.session.add(ai_message)
+        # Reuse a cached thread for a semantically similar query on the same chunk
+        cached_tweets = None
+        cache_query = user_query or prompt
+        query_embedding = None
+        if llm_cache:
+            try:
+                query_embedding = client.embeddings.create(
+                    model="text-embedding-3-small",
+                    input=cache_query
+                ).data[0].embedding
+                cached_tweets = llm_cache.lookup(content_id, content_chunk_id, query_embedding)
+                if cached_tweets is not None:
+                    log.debug("Semantic cache hit for content_chunk_id: %s", content_chunk_id)
+            except Exception as e:
+                log.warning("Semantic cache lookup failed: %s", e)
+
+        if cached_tweets is not None:
+            tweets = iter(cached_tweets)
+        else:
+            # Make streaming API call to GPT-4o
+            log.debug("Making API call to GPT-4o for response generation.")
+            stream = client.chat.completions.create(
+                model="gpt-4o",
+                messages=prompt_messages,
+                response_format={"type": "json_object"},
+                prompt_cache_key=f"conversation-{conversation_id}",
+                stream=True
+            )
+            tweets = iter_json_objects(iter_completion_text(stream))
+
+        def save_reply():
+            # Step 6: Yield each tweet as soon as it is complete, then add them all to the conversation
+            generated = []
+            for tweet in tweets:
+                generated.append({
+                    'conversation_id': conversation_id,
+                    'sender': SenderType.ai,
+                    'message_text': tweet['tweet'],
+                    'content_chunk_id': content_chunk_id
+                })
+                yield tweet
+            if not generated:
+                raise ValueError("No tweets found in response")
+            # Single multi-row INSERT instead of one ORM insert per tweet
+            db.session.execute(Message.__table__.insert(), generated)
             db.session.commit()
-            logging.info(f"AI messages appended to conversation {conversation_id}.")
-        except Exception as e:
-            logging.error(f"Error while adding AI messages to the database: {str(e)}")
-            return jsonify({'error': 'Invalid JSON response from GPT-4o'}), 500                
 
-        # Acknowledgment
-        return jsonify({'message': 'AI messages appended to conversation'}), 200
+            if cached_tweets is None and query_embedding is not None:
+                try:
+                    llm_cache.store(
+                        content_id,
+                        content_chunk_id,
+                        cache_query,
+                        query_embedding,
+                        [{'tweet': row['message_text']} for row in generated]
+                    )
+                except Exception as e:
+                    log.warning("Semantic cache store failed: %s", e)
+
+            # One summary line per request; step-by-step details are logged at DEBUG
+            log.info(
+                "AI reply appended to conversation %s: chunk=%s messages=%d tweets=%d cache_hit=%s elapsed_ms=%d",
+                conversation_id, content_chunk_id, len(messages), len(generated),
+                cached_tweets is not None, (time.monotonic() - started) * 1000
+            )
+
+        def generate():
+            reply = save_reply()
+            try:
+                for tweet in reply:
+                    yield json.dumps(tweet) + '\n'
+            except GeneratorExit:
+                # The client went away mid-stream; finish reading the reply and save it anyway
+                try:
+                    for _ in reply:
+                        pass
+                except Exception as e:
+                    db.session.rollback()
+                    log.error("Error while adding AI messages to the database: %s", e)
+                raise
+            except Exception as e:
+                db.session.rollback()
+                log.error("Error while adding AI messages to the database: %s", e)
+                yield json.dumps({'error': 'Invalid JSON response from GPT-4o'}) + '\n'
+                return
+
+            # Acknowledgment
+            yield json.dumps({'message': 'AI messages appended to conversation'}) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
     except Exception as e:
-        logging.error(f"Error in post_message_ai: {str(e)}")
+        log.error("Error in post_message_ai: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
     
 # add middleware
 @app.before_request
 def log_request_info():
-    logging.info(f"Headers: {request.headers}")
-    logging.info(f"Body: {request.get_data()}")
+    # Reading and formatting the full body is only worth it when debugging
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Headers: %s", request.headers)
+        log.debug("Body: %s", request.get_data())
 
     # for now just check that it has a Authorization header
     if 'X-API-KEY' not in request.headers:
-        logging.warning("No X-API-KEY header")
+        log.warning("No X-API-KEY header")
         return jsonify({'error': 'No X-API-KEY'}), 401
     
     x_api_key = request.headers.get('X-API-KEY')
-    if x_api_key != API_KEY:
-        logging.warning("Invalid X-API-KEY")
+    if not API_KEY or not hmac.compare_digest(x_api_key.encode(), API_KEY.encode()):
+        log.warning("Invalid X-API-KEY")
         return jsonify({'error': 'Invalid X-API-KEY'}), 401
     else:
         return
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=C_PORT)
\ No newline at end of file
+    # Local development only; production runs under gunicorn (see gunicorn.conf.py)
+    app.run(host='0.0.0.0', port=C_PORT)
\ No newline at end of file
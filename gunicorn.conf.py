@@ -0,0 +1,13 @@
+import multiprocessing
+import os
+
+# Settings come from the environment only: this file runs in the master before gevent
+# patches the workers, so it must not import anything that pulls in ssl (e.g. boto3)
+
+# gevent workers keep serving other requests while one waits on GPT-4o or a downstream service
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = "gevent"
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# Also read by app.py to size its downstream HTTP pools
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 100))
+timeout = 60
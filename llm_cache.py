@@ -0,0 +1,61 @@
+import hashlib
+import json
+
+import numpy as np
+import redis
+
+
+class SemanticCache:
+    """
+    Redis-backed cache of generated tweet threads.
+
+    Entries are grouped in a bucket per (content_id, chunk_id) and matched by
+    cosine similarity between the embedding of the user query and the
+    embeddings of previously answered queries in the same bucket.
+    """
+
+    def __init__(self, redis_url, threshold=0.92, ttl=3600, prefix='semcache'):
+        self.redis = redis.Redis.from_url(redis_url)
+        self.threshold = threshold
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _bucket_key(self, content_id, chunk_id):
+        return f"{self.prefix}:{content_id}:{chunk_id}"
+
+    def lookup(self, content_id, chunk_id, embedding):
+        """Return the cached tweets for the closest matching query, or None on a miss."""
+        bucket = self._bucket_key(content_id, chunk_id)
+        entry_ids = [entry_id.decode() for entry_id in self.redis.smembers(bucket)]
+        if not entry_ids:
+            return None
+
+        raw_embeddings = self.redis.mget([f"{bucket}:emb:{entry_id}" for entry_id in entry_ids])
+        live = [(entry_id, raw) for entry_id, raw in zip(entry_ids, raw_embeddings) if raw is not None]
+        expired = [entry_id for entry_id, raw in zip(entry_ids, raw_embeddings) if raw is None]
+        if expired:
+            self.redis.srem(bucket, *expired)
+        if not live:
+            return None
+
+        cached = np.frombuffer(b''.join(raw for _, raw in live), dtype=np.float32).reshape(len(live), -1)
+        query = np.asarray(embedding, dtype=np.float32)
+        similarities = cached @ query / (np.linalg.norm(cached, axis=1) * np.linalg.norm(query))
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+
+        tweets = self.redis.get(f"{bucket}:tweets:{live[best][0]}")
+        return json.loads(tweets) if tweets is not None else None
+
+    def store(self, content_id, chunk_id, query_text, embedding, tweets):
+        """Cache the tweets generated for query_text, keyed only on the query and chunk."""
+        bucket = self._bucket_key(content_id, chunk_id)
+        entry_id = hashlib.sha256(query_text.encode('utf-8')).hexdigest()
+
+        pipe = self.redis.pipeline()
+        pipe.set(f"{bucket}:emb:{entry_id}", np.asarray(embedding, dtype=np.float32).tobytes(), ex=self.ttl)
+        pipe.set(f"{bucket}:tweets:{entry_id}", json.dumps(tweets), ex=self.ttl)
+        pipe.sadd(bucket, entry_id)
+        pipe.expire(bucket, self.ttl)
+        pipe.execute()